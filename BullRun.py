@@ -6,10 +6,58 @@ while escaping a bull chasing form behind.
 @version August 1, 2016
 """
 
-import pygame, sys, random, time
-
-# Start Pygame
-pygame.init()
+import pygame, sys, random, time, os, struct, zlib
+import argparse, hashlib, json, tracemalloc, math
+import atexit, gzip, queue, threading, collections, weakref, asyncio
+import BullRunRelay
+
+# The resource module is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# NumPy is only needed for the particle effects, which are left out without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def parseOptions():
+    """ This function reads the options the game was started with """
+    parser = argparse.ArgumentParser(description='Bull Run')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='trace allocations and write a memory report at the end of every round')
+    parser.add_argument('--pacing', choices=('tick', 'tick_busy_loop', 'hybrid', 'vsync'), default='tick',
+                        help='how the game waits for the next frame: by sleeping (tick), spinning '
+                             '(tick_busy_loop), sleeping and then spinning (hybrid) or for the '
+                             'display refresh (vsync)')
+    parser.add_argument('--telemetry', metavar='DIRECTORY',
+                        help='write compressed logs of every run to this directory')
+    parser.add_argument('--race', metavar='HOST:PORT',
+                        help='race other cabinets through the relay at this address')
+    parser.add_argument('--room', default='bullrun',
+                        help='the room to race in on the relay')
+    options, unknown = parser.parse_known_args()
+
+    # The room name has to fit in the message that joins it
+    if len(options.room.encode('utf-8')) > BullRunRelay.MAX_ROOM_BYTES:
+        parser.error('--room can be at most %s bytes long' % BullRunRelay.MAX_ROOM_BYTES)
+    return options
+
+options = parseOptions()
+
+# Starts tracing allocations before anything else is loaded so the memory report sees them.
+# Otherwise tracing starts with the first report asked for with the memory report key.
+tracingSince = None
+if options.memory_report:
+    tracemalloc.start()
+    tracingSince = time.time()
+
+# Start the parts of Pygame the game needs straight away; the mixer is started the
+# first time a sound is needed
+pygame.display.init()
+pygame.font.init()
 
 # Colors
 BLACK = (0, 0, 0)
@@ -23,16 +71,295 @@ SCREEN_HEIGHT = 700
 # Frames per second
 FPS = 60
 
+# Ghost runner file and how many ticks pass between recorded samples
+GHOST_FILE = 'ghost.dat'
+GHOST_SAMPLE_TICKS = 2
+# How many compressed bytes are read from a ghost file at a time
+GHOST_READ_SIZE = 4096
+# The ghost file starts with a magic word, the sample spacing, the score of the run and
+# the seed its course was laid out from
+GHOST_MAGIC = b'BRG2'
+GHOST_HEADER = struct.Struct('<4sBII')
+
+# Each animation is a sprite sheet with its frames side by side, how many frames are on
+# it and how many ticks each frame is shown for. Until a sheet exists, the animation
+# shows the character's single image instead.
+TORERO_IMAGE = 'torero.png'
+TORERO_ANIMATIONS = {
+    'stand': ('torero.png', 1, 1),
+    'run': ('toreroRun.png', 6, 5),
+    'jump': ('toreroJump.png', 2, 10)
+}
+BULL_IMAGE = 'bull2.jpg'
+BULL_SIZE = (200, 200)
+BULL_ANIMATIONS = {
+    'charge': ('bullCharge.png', 4, 6)
+}
+
+# How many times a second the player's state is sent in a race, and how often a full
+# state is sent instead of a change, so a dropped state is recovered from within the
+# extrapolation limit
+RACE_SEND_RATE = 20
+RACE_FULL_STATE_SENDS = 5
+# Opponents are shown this many seconds behind their newest state, and are carried on
+# from their newest state for at most the limit if no new state arrives
+RACE_INTERPOLATION_DELAY = 0.1
+RACE_EXTRAPOLATION_LIMIT = 0.25
+# How many of each opponent's states are kept, how long to wait to join a race and
+# the color opponents are tinted and how solid they are drawn
+RACE_STATES_KEPT = 16
+RACE_CONNECT_TIMEOUT = 3
+RACE_OPPONENT_TINT = (120, 170, 255)
+RACE_OPPONENT_ALPHA = 170
+
+# How fast the street images scroll compared to the platforms
+STREET_SCROLL_FACTOR = 0.5
+# How many pixels at the start of a background image are faded into the part of the
+# image that would come after its end, so the image wraps around without a seam
+LAYER_BLEND_WIDTH = 100
+
+# How many particles can be on the screen at once and how many random numbers are
+# made ahead of time for new particles
+PARTICLE_CAPACITY = 30000
+PARTICLE_RANDOM_NUMBERS = 65536
+
+# Memory report file, the key that writes it and the memory a kiosk can spare (512 MB)
+MEMORY_REPORT_FILE = 'memoryReport.json'
+MEMORY_REPORT_KEY = pygame.K_F9
+MEMORY_BUDGET = 512 * 1024 * 1024
+
+# The hybrid frame pacer sleeps until this many seconds before a frame is due and then spins
+PACING_SPIN_TIME = 0.002
+# The frame time histogram has one bucket per millisecond; the last one holds anything slower
+PACING_HISTOGRAM_BUCKETS = 50
+# The key that shows the frame pacing statistics during a round
+PACING_STATS_KEY = pygame.K_F8
+# The vsync pacer falls back to the hybrid one after this many frames in a row shorter
+# than this share of the frame time, which means the flip is not waiting for the refresh
+VSYNC_FAST_FRAMES = 30
+VSYNC_FAST_SHARE = 0.5
+
+# The quality levels the governor steps down through when frames take too long
+QUALITY_LEVELS = ('full', 'slowHud', 'noEffects', 'lowResolution', 'skipFrames')
+# The governor steps down when frames use more than the first share of the frame time
+# and back up when they use less than the second
+GOVERNOR_STEP_DOWN = 0.9
+GOVERNOR_STEP_UP = 0.5
+# How many frames the governor averages over before it changes the quality again
+GOVERNOR_WINDOW = 30
+# The most simulation ticks run for one frame; time beyond that is let go
+MAX_TICKS_PER_FRAME = 5
+# A tick that is due within this many seconds is run now instead of next frame
+TICK_SLACK = 0.002
+# How many frames the score and lives text is kept for once the HUD is slowed down
+HUD_REFRESH_FRAMES = 10
+
+# Telemetry files are started over after this many uncompressed bytes, and the oldest
+# files are deleted once the telemetry directory holds more than the directory cap
+TELEMETRY_FILE_BYTES = 1024 * 1024
+TELEMETRY_DIRECTORY_BYTES = 50 * 1024 * 1024
+# How many events can wait to be written, and how many are written at a time
+TELEMETRY_QUEUE_SIZE = 10000
+TELEMETRY_BATCH_SIZE = 256
+
 # Set up the different types of fonts
 font = pygame.font.SysFont('Courier New', 50, True, False)
 font2 = pygame.font.SysFont('Georgia', 29, True, False)
 fontScore = pygame.font.SysFont(None, 50, True, False)
 
+# Mixer settings; the small buffer keeps the delay between a collision and its sound short
+AUDIO_FREQUENCY = 44100
+AUDIO_BUFFER = 512
+AUDIO_CHANNELS = 8
+
+# The sound effect files and the mixer channel kept for each of them
+SOUND_FILES = {'bull': 'bullSoundEffect.wav', 'gameOver': 'gameover.wav'}
+SOUND_CHANNELS = {'bull': 0, 'gameOver': 1}
+MUSIC_FILE = 'bullfightingMusic.wav'
+
+class AudioManager(object):
+    """ This class starts the mixer the first time it is needed, plays each sound effect
+    on its own reserved channel and keeps the music loaded between rounds """
+
+    def __init__(self):
+        self.started = False
+        self.enabled = False
+        # Sound effects that have already been loaded and the channels kept for them
+        self.sounds = {}
+        self.channels = {}
+        self.musicLoaded = False
+        self.musicPaused = False
+
+    def start(self):
+        """ This function starts the mixer if it has not been started yet and returns
+        whether sound can be played """
+        if self.started:
+            return self.enabled
+        self.started = True
+
+        try:
+            pygame.mixer.init(AUDIO_FREQUENCY, -16, 2, AUDIO_BUFFER)
+        except pygame.error:
+            # Plays the game silently if there is no sound device
+            return False
+        self.enabled = True
+
+        # Keeps the first channels free for the sound effects that have to play right away
+        pygame.mixer.set_num_channels(AUDIO_CHANNELS)
+        pygame.mixer.set_reserved(len(SOUND_CHANNELS))
+        for name, number in SOUND_CHANNELS.items():
+            self.channels[name] = pygame.mixer.Channel(number)
+        return True
+
+    def sound(self, name):
+        """ This function returns a sound effect, loading it the first time it is used """
+        if name not in self.sounds:
+            self.sounds[name] = pygame.mixer.Sound(SOUND_FILES[name])
+        return self.sounds[name]
+
+    def preload(self):
+        """ This function loads all of the sound effects and the music ahead of time """
+        if self.start():
+            for name in SOUND_FILES:
+                self.sound(name)
+            self.loadMusic()
+
+    def play(self, name):
+        """ This function plays a sound effect on its own channel """
+        if self.start():
+            self.channels[name].play(self.sound(name))
+
+    def loadMusic(self):
+        """ This function opens the music so it can be streamed """
+        if not self.musicLoaded:
+            pygame.mixer.music.load(MUSIC_FILE)
+            self.musicLoaded = True
+
+    def startMusic(self):
+        """ This function starts the music from the beginning without loading it again """
+        if not self.start():
+            return
+        self.loadMusic()
+
+        if self.musicPaused:
+            pygame.mixer.music.rewind()
+            pygame.mixer.music.unpause()
+            self.musicPaused = False
+        elif pygame.mixer.music.get_busy():
+            pygame.mixer.music.rewind()
+        else:
+            pygame.mixer.music.play(-1, 0.0)
+
+    def stopMusic(self):
+        """ This function stops the music, keeping it loaded for the next round """
+        if self.enabled and self.musicLoaded:
+            pygame.mixer.music.pause()
+            self.musicPaused = True
+
 # Set up the sound effects/music
-bullSoundEffect = pygame.mixer.Sound('bullSoundEffect.wav')
-gameOverSound = pygame.mixer.Sound('gameover.wav')
-pygame.mixer.music.load('bullfightingMusic.wav')
+audio = AudioManager()
+
+
+def sweptCollision(rect, changeX, changeY, obstacle):
+    """ This function sweeps a rectangle along its movement and finds when it first
+    touches an obstacle. It returns the fraction of the movement made before the hit
+    and the side that was hit as (time, normalX, normalY), or None if there is no hit.
+    A rectangle that already overlaps the obstacle hits it straight away on the side
+    it is least far into, so it is pushed back out that way. """
+
+    # Pushes the rectangle out the shortest way if it is already inside the obstacle
+    if rect.colliderect(obstacle):
+        depth, normalX, normalY = min((rect.right - obstacle.left, -1, 0),
+                                      (obstacle.right - rect.left, 1, 0),
+                                      (rect.bottom - obstacle.top, 0, -1),
+                                      (obstacle.bottom - rect.top, 0, 1))
+        return 0.0, normalX, normalY
+
+    # Finds when the rectangle starts and stops overlapping the obstacle along the x-axis
+    if changeX > 0:
+        entryX = (obstacle.left - rect.right) / changeX
+        exitX = (obstacle.right - rect.left) / changeX
+    elif changeX < 0:
+        entryX = (obstacle.right - rect.left) / changeX
+        exitX = (obstacle.left - rect.right) / changeX
+    elif rect.right <= obstacle.left or rect.left >= obstacle.right:
+        return None
+    else:
+        entryX, exitX = float('-inf'), float('inf')
+
+    # Does the same along the y-axis
+    if changeY > 0:
+        entryY = (obstacle.top - rect.bottom) / changeY
+        exitY = (obstacle.bottom - rect.top) / changeY
+    elif changeY < 0:
+        entryY = (obstacle.bottom - rect.top) / changeY
+        exitY = (obstacle.top - rect.bottom) / changeY
+    elif rect.bottom <= obstacle.top or rect.top >= obstacle.bottom:
+        return None
+    else:
+        entryY, exitY = float('-inf'), float('inf')
+
+    # The rectangles only touch while they overlap on both axes at once
+    entry = max(entryX, entryY)
+    if entry > min(exitX, exitY) or entry < 0 or entry >= 1:
+        return None
+
+    # The axis that started overlapping last is the side that was hit
+    if entryX > entryY:
+        return entry, (-1 if changeX > 0 else 1), 0
+    return entry, 0, (-1 if changeY > 0 else 1)
+
+def imageMask(image, backgroundColor=None):
+    """ This function builds the collision mask for an image. If a background color is
+    given, every pixel close to that color is left out of the mask, which also catches
+    the JPEG noise around a colorkey. """
+    if backgroundColor is None:
+        return pygame.mask.from_surface(image)
+    mask = pygame.mask.from_threshold(image, backgroundColor, (40, 40, 40, 255))
+    mask.invert()
+    return mask
+
+class FrameCache(object):
+    """ This class cuts sprite sheets into frames and keeps every scaled and flipped
+    frame with its mask, so each one is only ever made once and is shared by every
+    sprite that uses it """
 
+    def __init__(self):
+        self.frames = {}
+
+    def get(self, fileName, frameCount, fallbackFile, size=None, flip=False, backgroundColor=None):
+        """ This function returns a sprite sheet's frames as (image, mask) pairs. The
+        fallback file is used as a single frame if the sprite sheet does not exist. """
+        key = (fileName, frameCount, size, flip, backgroundColor)
+        if key not in self.frames:
+            if not os.path.exists(fileName):
+                self.frames[key] = self.get(fallbackFile, 1, fallbackFile, size, flip, backgroundColor)
+            else:
+                self.frames[key] = self.load(fileName, frameCount, size, flip, backgroundColor)
+        return self.frames[key]
+
+    def load(self, fileName, frameCount, size, flip, backgroundColor):
+        """ This function loads a sprite sheet and makes each of its frames """
+        sheet = pygame.image.load(fileName)
+        if backgroundColor is None:
+            sheet = sheet.convert_alpha()
+        else:
+            # Gets rid of the background around the frames
+            sheet = sheet.convert()
+            sheet.set_colorkey(backgroundColor)
+
+        frames = []
+        frameWidth = sheet.get_width() // frameCount
+        for number in range(frameCount):
+            image = sheet.subsurface((number * frameWidth, 0, frameWidth, sheet.get_height()))
+            if size is not None:
+                image = pygame.transform.scale(image, size)
+            else:
+                image = image.copy()
+            if flip:
+                image = pygame.transform.flip(image, True, False)
+            frames.append((image, imageMask(image, backgroundColor)))
+        return tuple(frames)
 
 class Player(pygame.sprite.Sprite):
     """ This class sets up the torero character and the gravity, sprite collisions,
@@ -44,8 +371,18 @@ class Player(pygame.sprite.Sprite):
         # This calls the parent class' constructor
         super().__init__()
 
-        # Loads the torero image of the player and creates a rectangle reference for it
-        self.image = pygame.image.load('torero.png')
+        # Gets the torero's frames for each animation facing right and facing left
+        self.animations = {}
+        for name, (fileName, frameCount, ticksPerFrame) in TORERO_ANIMATIONS.items():
+            for facingLeft in (False, True):
+                frames = frameCache.get(fileName, frameCount, TORERO_IMAGE, flip=facingLeft)
+                self.animations[name, facingLeft] = (frames, ticksPerFrame)
+        self.animation = ('stand', False)
+        self.animationTicks = 0
+
+        # Sets the torero's image and the mask of the pixels that can touch the bull,
+        # and creates a rectangle reference for it
+        self.image, self.mask = self.animations[self.animation][0][0]
         self.rect = self.image.get_rect()
 
         # Sets the torero's speed
@@ -75,44 +412,81 @@ class Player(pygame.sprite.Sprite):
         # Checks for gravity
         self.gravity()
 
-        # Moves the character left or right
-        self.rect.x += self.changeX
+        # How far the player still has to move this tick
+        moveX = self.changeX
+        moveY = self.changeY
 
-        # Checks to see if the player ran into a platform in the x-direction
-        platformHitList = pygame.sprite.spritecollide(self, self.level.platform_list, False)
-
-        for item in platformHitList:
-            # Lets the player jump if it has collided with a platform
-            for event in pygame.event.get():
-                if event.key == pygame.K_UP:
-                    self.jump()
-            # If the player moves right, it will touch the left side of the platform
-            if self.changeX > 0:
-                self.rect.right = item.rect.left
-            elif self.changeX < 0:
-                # If the player moves left, it will touch the right side of the platform
-                self.rect.left = item.rect.right
-
-        # Moves the player up (back down)
-        self.rect.y += self.changeY
-
-        # Checks to see if the player ran into a platform in the y-direction
-        platformHitList = pygame.sprite.spritecollide(self, self.level.platform_list, False)
-
-        for item in platformHitList:
+        # Sweeps the player along its movement, sliding along each platform it hits.
+        # Three passes are enough to land in a corner between two platforms.
+        for attempt in range(3):
+            if moveX == 0 and moveY == 0:
+                break
 
-            for event in pygame.event.get():
-                if event.key == pygame.K_UP:
-                    self.jump()
+            # Only platforms inside the area the player sweeps through can be hit. The area
+            # is grown by a pixel on every side because Rect.move drops the fraction of a
+            # move that adding onto the rectangle's position rounds up.
+            sweptArea = self.rect.union(self.rect.move(moveX, moveY)).inflate(2, 2)
+            firstHit = None
+            for item in self.level.platform_list:
+                if sweptArea.colliderect(item.rect):
+                    hit = sweptCollision(self.rect, moveX, moveY, item.rect)
+                    if hit is not None and (firstHit is None or hit[0] < firstHit[0]):
+                        firstHit = hit + (item,)
+
+            # Moves the whole way if nothing is in the way
+            if firstHit is None:
+                self.rect.x += moveX
+                self.rect.y += moveY
+                break
 
-            if self.changeY > 0:
-                self.rect.bottom = item.rect.top
-            elif self.changeY < 0:
-                self.rect.top = item.rect.bottom
+            hitTime, normalX, normalY, item = firstHit
+
+            if normalX != 0:
+                # Touches the side of the platform and keeps moving up or down
+                if normalX < 0:
+                    self.rect.right = item.rect.left
+                else:
+                    self.rect.left = item.rect.right
+                self.rect.y += moveY * hitTime
+                moveX = 0
+                moveY *= 1 - hitTime
+            else:
+                # Lands on top of the platform or hits its underside and keeps moving sideways
+                if normalY < 0:
+                    self.rect.bottom = item.rect.top
+                else:
+                    self.rect.top = item.rect.bottom
+                self.rect.x += moveX * hitTime
+                moveX *= 1 - hitTime
+                moveY = 0
+
+                # Stops the player from moving vertically
+                self.changeY = 0
+
+        self.animate()
+
+    def animate(self):
+        """ This function moves the torero's animation on by one tick """
+
+        # Picks the animation from how the player is moving and which way it faces
+        facingLeft = self.animation[1]
+        if self.changeX != 0:
+            facingLeft = self.changeX < 0
+        if self.changeY != 0:
+            animation = ('jump', facingLeft)
+        elif self.changeX != 0:
+            animation = ('run', facingLeft)
+        else:
+            animation = ('stand', facingLeft)
 
-            # Stops the player from moving vertically
-            self.changeY = 0
+        # Starts a new animation from its first frame
+        if animation != self.animation:
+            self.animation = animation
+            self.animationTicks = 0
 
+        frames, ticksPerFrame = self.animations[animation]
+        self.image, self.mask = frames[(self.animationTicks // ticksPerFrame) % len(frames)]
+        self.animationTicks += 1
 
     def jump(self):
         """ This function makes the player jump """
@@ -141,21 +515,27 @@ class Player(pygame.sprite.Sprite):
 
 class Bull(pygame.sprite.Sprite):
     """ This class sets up the Bull character """
+
     def __init__(self):
 
         super().__init__()
 
-        # Loads the bull image
-        self.image = pygame.image.load('bull2.jpg').convert()
-        # Gets rid of the white background around the image
-        self.image.set_colorkey(WHITE)
-        # Scales the bull to the right size
-        self.image = pygame.transform.scale(self.image, (200, 200))
-        # Flips the image across the y-axis (180 degrees)
-        self.image = pygame.transform.flip(self.image, 180, 0)
-        # Creates a rectangle reference for the bull.
+        # Gets the bull's charging frames, scaled to the right size, flipped across the
+        # y-axis and with the white background around the image left out
+        fileName, frameCount, self.ticksPerFrame = BULL_ANIMATIONS['charge']
+        self.frames = frameCache.get(fileName, frameCount, BULL_IMAGE, BULL_SIZE, True, WHITE)
+        self.animationTicks = 0
+
+        # Sets the bull's image and mask and creates a rectangle reference for the bull.
+        self.image, self.mask = self.frames[0]
         self.rect = self.image.get_rect()
 
+    def update(self):
+        """ This function moves the bull's charging animation on by one tick """
+        self.animationTicks += 1
+        frameNo = (self.animationTicks // self.ticksPerFrame) % len(self.frames)
+        self.image, self.mask = self.frames[frameNo]
+
 class Platform(pygame.sprite.Sprite):
     """ This class sets up the platforms that the player can jump onto """
 
@@ -170,6 +550,707 @@ class Platform(pygame.sprite.Sprite):
         # Creates a rectangle reference for the platforms
         self.rect = self.image.get_rect()
 
+class GhostRecorder(object):
+    """ This class records where the player is during a run so the run can be
+    saved as a ghost file and raced against later """
+
+    # Each sample is stored as the change in background number, position and height
+    sampleFormat = struct.Struct('<bhh')
+
+    def __init__(self, seed):
+        # The seed the run's course was laid out from
+        self.seed = seed
+        # Compresses the samples as they come in so only small chunks are kept in memory
+        self.compressor = zlib.compressobj(9)
+        self.chunks = []
+        # Counts the ticks so only every GHOST_SAMPLE_TICKS tick is recorded
+        self.ticks = 0
+        # The last sample recorded, which the next sample is stored relative to
+        self.lastSample = (0, 0, 0)
+
+    def record(self, backgroundNo, position, y):
+        """ This function is called once per tick with the player's background number,
+        position and height """
+        if self.ticks % GHOST_SAMPLE_TICKS == 0:
+            sample = (backgroundNo, position, y)
+            delta = [new - old for new, old in zip(sample, self.lastSample)]
+            self.lastSample = sample
+
+            chunk = self.compressor.compress(self.sampleFormat.pack(*delta))
+            if chunk:
+                self.chunks.append(chunk)
+
+        self.ticks += 1
+
+    def save(self, score, fileName=GHOST_FILE):
+        """ This function writes the recorded run to the ghost file """
+        self.chunks.append(self.compressor.flush())
+
+        # Writes to a temporary file first so a crash never leaves a half written ghost
+        tempName = fileName + '.tmp'
+        with open(tempName, 'wb') as ghostFile:
+            ghostFile.write(GHOST_HEADER.pack(GHOST_MAGIC, GHOST_SAMPLE_TICKS, score, self.seed))
+            ghostFile.writelines(self.chunks)
+        os.replace(tempName, fileName)
+
+class GhostReader(object):
+    """ This class streams the samples back out of a ghost file, decompressing a
+    small piece of the file at a time """
+
+    def __init__(self, fileName=GHOST_FILE):
+        self.ghostFile = open(fileName, 'rb')
+        header = self.ghostFile.read(GHOST_HEADER.size)
+
+        # Makes sure the file really is a ghost file
+        if len(header) < GHOST_HEADER.size or header[:4] != GHOST_MAGIC:
+            self.ghostFile.close()
+            raise ValueError('%s is not a ghost file' % fileName)
+        magic, self.sampleTicks, self.score, self.seed = GHOST_HEADER.unpack(header)
+
+        # Makes sure the samples are at least one tick apart
+        if self.sampleTicks < 1:
+            self.ghostFile.close()
+            raise ValueError('%s has a bad sample spacing' % fileName)
+
+        self.decompressor = zlib.decompressobj()
+        # Decompressed bytes waiting to be read and how far into them we have read
+        self.buffer = b''
+        self.offset = 0
+        # The last sample read, which the next delta is added onto
+        self.sample = (0, 0, 0)
+
+    def next(self):
+        """ This function returns the next (background number, position, height) sample,
+        or None once the end of the run is reached """
+        size = GhostRecorder.sampleFormat.size
+
+        # Decompresses more of the file once the buffer runs low
+        while len(self.buffer) - self.offset < size:
+            if self.ghostFile.closed:
+                return None
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.ghostFile.read(GHOST_READ_SIZE)
+            if not data:
+                self.close()
+                return None
+            try:
+                more = self.decompressor.decompress(data, GHOST_READ_SIZE)
+            except zlib.error:
+                self.close()
+                return None
+            self.buffer = self.buffer[self.offset:] + more
+            self.offset = 0
+
+        delta = GhostRecorder.sampleFormat.unpack_from(self.buffer, self.offset)
+        self.offset += size
+        self.sample = tuple(old + change for old, change in zip(self.sample, delta))
+        return self.sample
+
+    def close(self):
+        """ This function closes the ghost file """
+        self.ghostFile.close()
+
+def loadGhost():
+    """ This function opens the saved ghost run, or returns None if there is not one """
+    try:
+        return GhostReader(GHOST_FILE)
+    except (OSError, ValueError):
+        return None
+
+# The see-through torero images, made once for each alpha and tint and shared by every
+# ghost and opponent
+shadowImages = {}
+
+def shadowImage(alpha, tint=None):
+    """ This function returns the torero image tinted and made see-through """
+    if (alpha, tint) not in shadowImages:
+        image = pygame.image.load(TORERO_IMAGE).convert_alpha()
+        if tint is not None:
+            image.fill(tint, special_flags=pygame.BLEND_RGB_MULT)
+        image.set_alpha(alpha)
+        shadowImages[(alpha, tint)] = image
+    return shadowImages[(alpha, tint)]
+
+class ShadowRunner(pygame.sprite.Sprite):
+    """ This is a parent class for the see-through toreros that are drawn where another
+    run is, given as a background number, position and height like the player's """
+
+    def __init__(self, alpha, tint=None):
+
+        super().__init__()
+
+        # Shares the tinted, see-through torero image
+        self.image = shadowImage(alpha, tint)
+        self.rect = self.image.get_rect()
+
+        # The background number, position and height of the run
+        self.backgroundNo = None
+        self.position = 0
+        self.y = 0
+
+    def place(self, backgroundNo, background):
+        """ This function places the torero on the screen for the current background """
+        if self.backgroundNo == backgroundNo:
+            self.rect.x = round(self.position) - background.background_shift
+            self.rect.y = round(self.y)
+        else:
+            self.hide()
+
+    def hide(self):
+        """ This function keeps the torero off the screen """
+        self.rect.x = -SCREEN_WIDTH
+
+class Ghost(ShadowRunner):
+    """ This class sets up a see-through torero that replays the best previous run """
+
+    def __init__(self, reader):
+
+        ShadowRunner.__init__(self, 100)
+
+        # The samples on either side of the ghost's current tick
+        self.reader = reader
+        self.previous = reader.next()
+        self.following = reader.next()
+        self.ticks = 0
+
+    def update(self):
+        """ This function moves the ghost one tick further through its run """
+
+        # Moves onto the next pair of samples
+        if self.ticks == self.reader.sampleTicks:
+            self.previous = self.following
+            self.following = self.reader.next()
+            self.ticks = 0
+
+        if self.previous is None:
+            self.backgroundNo = None
+            return
+
+        self.backgroundNo, self.position, self.y = self.previous
+
+        # Blends between the two samples unless the ghost changes background in between
+        if self.following is not None and self.following[0] == self.backgroundNo:
+            fraction = self.ticks / self.reader.sampleTicks
+            self.position += (self.following[1] - self.position) * fraction
+            self.y += (self.following[2] - self.y) * fraction
+
+        self.ticks += 1
+
+class Opponent(ShadowRunner):
+    """ This class sets up a tinted torero that shows another cabinet's player in a race """
+
+    def __init__(self, states):
+
+        ShadowRunner.__init__(self, RACE_OPPONENT_ALPHA, RACE_OPPONENT_TINT)
+
+        # The opponent's latest states as (time received, background number, position, height)
+        self.states = states
+
+    def place(self, backgroundNo, background):
+        """ This function works out where the opponent was a moment ago, blending between
+        the states around that time or carrying on from the newest one, and places it """
+        self.follow(time.perf_counter() - RACE_INTERPOLATION_DELAY)
+        ShadowRunner.place(self, backgroundNo, background)
+
+    def follow(self, showTime):
+        """ This function sets the opponent's position for a moment in time """
+        states = list(self.states)
+        if not states:
+            self.backgroundNo = None
+            return
+
+        # Finds the newest state from before the moment being shown
+        index = len(states) - 1
+        while index > 0 and states[index][0] > showTime:
+            index -= 1
+        earlier = states[index]
+        self.backgroundNo, self.position, self.y = earlier[1:]
+
+        if index + 1 < len(states):
+            # Blends towards the next state if both are on the same background
+            later = states[index + 1]
+        elif index > 0 and showTime - earlier[0] < RACE_EXTRAPOLATION_LIMIT:
+            # Carries on in the same direction past the newest state, for a short while
+            later = earlier
+            earlier = states[index - 1]
+        else:
+            return
+
+        if later[1] == earlier[1] and later[0] > earlier[0]:
+            fraction = (showTime - earlier[0]) / (later[0] - earlier[0])
+            fraction = max(fraction, 0.0)
+            self.backgroundNo = earlier[1]
+            self.position = earlier[2] + (later[2] - earlier[2]) * fraction
+            self.y = earlier[3] + (later[3] - earlier[3]) * fraction
+
+class RaceClient(object):
+    """ This class connects to a race relay on a background thread. It sends the
+    player's latest state at a fixed rate, as small changes from the last state sent,
+    and collects the states of the other players in the room. Every state carries a
+    sequence number, so a change that follows a state the relay dropped is thrown away
+    instead of being added onto the wrong state. """
+
+    # A full state holds the sequence number, background number, position and height;
+    # a change only holds the sequence number and how far the position and height moved
+    fullFormat = struct.Struct('<cBBhh')
+    changeFormat = struct.Struct('<cBbb')
+
+    def __init__(self, host, port, room):
+        self.host = host
+        self.port = port
+        self.room = room
+
+        # The player's latest (background number, position, height), set by the game loop
+        self.state = None
+        # The player's number and the course seed, sent by the relay
+        self.playerNo = None
+        self.seed = None
+        self.welcomed = threading.Event()
+
+        # Each opponent's latest states, and the last state and sequence number received
+        # from each of them
+        self.opponents = {}
+        self.lastStates = {}
+        self.lastSequences = {}
+
+        self.thread = threading.Thread(target=self.run, name='race', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """ This function runs the connection on the background thread """
+        try:
+            asyncio.run(self.connect())
+        finally:
+            self.welcomed.set()
+
+    async def connect(self):
+        """ This function joins the room and then sends and receives states """
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            return
+        BullRunRelay.writeMessage(writer, BullRunRelay.JOIN + self.room.encode('utf-8'))
+
+        sending = asyncio.ensure_future(self.sendStates(writer))
+        try:
+            await self.receiveMessages(reader)
+        finally:
+            sending.cancel()
+            writer.close()
+            # Takes the opponents off the screen once the relay is gone
+            self.opponents.clear()
+            self.lastStates.clear()
+            self.lastSequences.clear()
+            if self.seed is not None:
+                print('Lost the connection to the race, playing alone', file=sys.stderr)
+
+    async def sendStates(self, writer):
+        """ This function sends the player's state RACE_SEND_RATE times a second """
+        loop = asyncio.get_running_loop()
+        nextSend = loop.time()
+        lastSent = None
+        sends = 0
+
+        while True:
+            nextSend += 1.0 / RACE_SEND_RATE
+            await asyncio.sleep(max(0.0, nextSend - loop.time()))
+            state = self.state
+            if state is None:
+                continue
+            # Keeps the position and height in the range a full state can hold
+            state = (state[0], max(-32768, min(32767, state[1])), max(-32768, min(32767, state[2])))
+
+            # Sends a full state now and then, or if the change is too big to send as one
+            sequence = sends % 256
+            if lastSent is not None and sends % RACE_FULL_STATE_SENDS != 0 and state[0] == lastSent[0]:
+                changeX = state[1] - lastSent[1]
+                changeY = state[2] - lastSent[2]
+                if -128 <= changeX <= 127 and -128 <= changeY <= 127:
+                    message = self.changeFormat.pack(b'D', sequence, changeX, changeY)
+                    state = (lastSent[0], lastSent[1] + changeX, lastSent[2] + changeY)
+                else:
+                    message = None
+            else:
+                message = None
+            if message is None:
+                message = self.fullFormat.pack(b'F', sequence, state[0], state[1], state[2])
+
+            BullRunRelay.writeMessage(writer, BullRunRelay.STATE + message)
+            await writer.drain()
+            lastSent = state
+            sends += 1
+
+    async def receiveMessages(self, reader):
+        """ This function reads messages from the relay until the connection closes """
+        while True:
+            message = await BullRunRelay.readMessage(reader)
+            if message is None:
+                return
+            kind = message[:1]
+
+            # Ignores any message that is too short or too long for its kind
+            try:
+                if kind == BullRunRelay.WELCOME:
+                    self.playerNo, self.seed = BullRunRelay.WELCOME_FORMAT.unpack(message[1:])
+                    self.welcomed.set()
+
+                elif kind == BullRunRelay.STATE:
+                    self.receiveState(message[1], message[2:])
+
+                elif kind == BullRunRelay.LEAVE:
+                    self.opponents.pop(message[1], None)
+                    self.lastStates.pop(message[1], None)
+                    self.lastSequences.pop(message[1], None)
+            except (struct.error, IndexError):
+                continue
+
+    def receiveState(self, playerNo, message):
+        """ This function decodes a state from another player and keeps it """
+        if message[:1] == b'F':
+            kind, sequence, backgroundNo, position, y = self.fullFormat.unpack(message)
+            state = (backgroundNo, position, y)
+        else:
+            kind, sequence, changeX, changeY = self.changeFormat.unpack(message)
+            last = self.lastStates.get(playerNo)
+            if last is None or sequence != (self.lastSequences[playerNo] + 1) % 256:
+                # Waits for the next full state if the player has just been seen or the
+                # relay dropped a state in between
+                self.lastStates.pop(playerNo, None)
+                return
+            state = (last[0], last[1] + changeX, last[2] + changeY)
+
+        self.lastStates[playerNo] = state
+        self.lastSequences[playerNo] = sequence
+        if playerNo not in self.opponents:
+            self.opponents[playerNo] = collections.deque(maxlen=RACE_STATES_KEPT)
+        self.opponents[playerNo].append((time.perf_counter(),) + state)
+
+def joinRace(address, room):
+    """ This function connects to a race relay given as host:port and waits to be let
+    into the room. It returns the race client, or None if the relay could not be reached. """
+    host, port = address.rsplit(':', 1)
+    raceClient = RaceClient(host, int(port), room)
+    raceClient.welcomed.wait(RACE_CONNECT_TIMEOUT)
+    if raceClient.seed is None:
+        print('Could not join the race at %s, playing alone' % address, file=sys.stderr)
+        return None
+    return raceClient
+
+
+class ParticleSystem(object):
+    """ This class runs the confetti, dust and impact effects. Every particle lives in
+    a slot of arrays that are made once, and all of them are moved and drawn together
+    with NumPy. Particles are drawn by writing their pixels straight into the screen,
+    using working arrays that are also made once. """
+
+    # For each kind of particle: the range of directions it flies in (in radians, where
+    # pi / 2 is straight down), the range of speeds, its gravity, how many ticks it
+    # lasts and the colors of its images
+    kinds = {
+        'confetti': (0.3 * math.pi, 0.7 * math.pi, 1.0, 3.0, 0.02, 400,
+                     [(230, 30, 30), (250, 200, 20), (30, 150, 230), (40, 180, 60), (240, 120, 200)]),
+        'dust': (1.0 * math.pi, 1.4 * math.pi, 0.5, 1.5, 0.02, 30,
+                 [(150, 120, 90), (170, 145, 110), (120, 95, 70)]),
+        'impact': (0.0, 2.0 * math.pi, 2.0, 7.0, 0.25, 35,
+                   [(255, 230, 80), (255, 140, 0), (255, 255, 255)])
+    }
+
+    def __init__(self, capacity=PARTICLE_CAPACITY):
+        self.enabled = numpy is not None
+        if not self.enabled:
+            return
+        self.capacity = capacity
+
+        # The position, speed, gravity, remaining ticks and image of every particle
+        self.x = numpy.zeros(capacity, numpy.float32)
+        self.y = numpy.zeros(capacity, numpy.float32)
+        self.changeX = numpy.zeros(capacity, numpy.float32)
+        self.changeY = numpy.zeros(capacity, numpy.float32)
+        self.gravity = numpy.zeros(capacity, numpy.float32)
+        self.life = numpy.zeros(capacity, numpy.int16)
+        self.sprite = numpy.zeros(capacity, numpy.int16)
+        self.kind = numpy.zeros(capacity, numpy.int8)
+        # The slot the next particle goes in; the oldest particles are replaced first
+        self.next = 0
+
+        # Space to work out directions and speeds in without making new arrays
+        self.angles = numpy.zeros(capacity, numpy.float32)
+        self.speeds = numpy.zeros(capacity, numpy.float32)
+        self.fallen = numpy.zeros(capacity, numpy.bool_)
+
+        # Space to work out which particles are drawn and which pixels they cover
+        self.drawX = numpy.zeros(capacity, numpy.int32)
+        self.drawY = numpy.zeros(capacity, numpy.int32)
+        self.drawn = numpy.zeros(capacity, numpy.bool_)
+        self.inside = numpy.zeros(capacity, numpy.bool_)
+        self.drawnX = numpy.zeros(capacity, numpy.int32)
+        self.drawnY = numpy.zeros(capacity, numpy.int32)
+        self.drawnSprite = numpy.zeros(capacity, numpy.int16)
+        self.corners = numpy.zeros(capacity, numpy.int64)
+        self.pixelIndexes = numpy.zeros(capacity, numpy.int64)
+        self.colors = numpy.zeros(capacity, numpy.uint32)
+        self.blendLow = numpy.zeros(capacity, numpy.uint32)
+        self.blendHigh = numpy.zeros(capacity, numpy.uint32)
+        self.pixels = numpy.zeros(capacity, numpy.uint32)
+
+        # Random numbers between 0 and 1 that new particles take in turn
+        self.randomNumbers = numpy.random.default_rng().random(PARTICLE_RANDOM_NUMBERS, numpy.float32)
+        self.randomOffset = 0
+
+        # Lists the colors of every kind of particle, remembering where each kind's start
+        self.spriteColors = []
+        self.kindSprites = {}
+        for kindNo, (kind, settings) in enumerate(self.kinds.items()):
+            colors = settings[6]
+            self.kindSprites[kind] = (kindNo, len(self.spriteColors), len(colors))
+            self.spriteColors.extend(colors)
+
+        # Works out the pixels each kind of particle covers, as offsets from its top left
+        # corner, and how see-through it is
+        self.shapes = []
+        for kind in self.kinds:
+            if kind == 'dust':
+                image = pygame.Surface((8, 8), pygame.SRCALPHA)
+                pygame.draw.circle(image, (255, 255, 255, 140), (4, 4), 4)
+                alpha = 140
+            else:
+                image = pygame.Surface((6, 4) if kind == 'confetti' else (4, 4), pygame.SRCALPHA)
+                image.fill((255, 255, 255, 255))
+                alpha = 255
+            offsetsX, offsetsY = numpy.nonzero(pygame.surfarray.array_alpha(image))
+            self.shapes.append((image.get_width(), image.get_height(), offsetsX, offsetsY, alpha))
+
+        # The colors in the pixel format of the surface last drawn on
+        self.pixelFormat = None
+        self.mappedColors = None
+
+    def random(self, count):
+        """ This function returns the next count random numbers from the ready-made ones """
+        if self.randomOffset + count > PARTICLE_RANDOM_NUMBERS:
+            self.randomOffset = 0
+        numbers = self.randomNumbers[self.randomOffset:self.randomOffset + count]
+        self.randomOffset += count
+        return numbers
+
+    def emit(self, kind, count, x, y, width=0):
+        """ This function starts count new particles spread across width pixels from (x, y) """
+        if not self.enabled:
+            return
+        count = min(count, self.capacity, PARTICLE_RANDOM_NUMBERS)
+
+        # Fills the slots after the last particle, going back to the start when they run out
+        while count > 0:
+            size = min(count, self.capacity - self.next)
+            self.emitInto(kind, slice(self.next, self.next + size), size, x, y, width)
+            self.next = (self.next + size) % self.capacity
+            count -= size
+
+    def emitInto(self, kind, slots, count, x, y, width):
+        """ This function fills a run of particle slots with new particles """
+        firstAngle, lastAngle, slowest, fastest, gravity, life, colors = self.kinds[kind]
+        kindNo, firstSprite, spriteCount = self.kindSprites[kind]
+        angles = self.angles[:count]
+        speeds = self.speeds[:count]
+
+        # Places the particles along the line they start from
+        numpy.multiply(self.random(count), width, out=self.x[slots])
+        self.x[slots] += x
+        self.y[slots] = y
+
+        # Picks a direction and speed for each particle and splits it into x and y speeds
+        numpy.multiply(self.random(count), lastAngle - firstAngle, out=angles)
+        angles += firstAngle
+        numpy.multiply(self.random(count), fastest - slowest, out=speeds)
+        speeds += slowest
+        numpy.cos(angles, out=self.changeX[slots])
+        self.changeX[slots] *= speeds
+        numpy.sin(angles, out=self.changeY[slots])
+        self.changeY[slots] *= speeds
+
+        self.gravity[slots] = gravity
+        self.life[slots] = life
+
+        # Picks one of the kind's images for each particle
+        numpy.multiply(self.random(count), spriteCount, out=speeds)
+        self.sprite[slots] = speeds
+        self.sprite[slots] += firstSprite
+        self.kind[slots] = kindNo
+
+    def update(self):
+        """ This function moves every particle one tick """
+        if not self.enabled:
+            return
+        self.x += self.changeX
+        self.y += self.changeY
+        self.changeY += self.gravity
+        self.life -= 1
+        # Ends the particles that have fallen off the bottom of the screen
+        numpy.greater(self.y, SCREEN_HEIGHT, out=self.fallen)
+        numpy.putmask(self.life, self.fallen, 0)
+        # Keeps finished particles from counting down forever
+        numpy.maximum(self.life, 0, out=self.life)
+
+    def shift(self, shiftX):
+        """ This function moves every particle along with the background """
+        if self.enabled:
+            self.x += shiftX
+
+    def mapColors(self, surface):
+        """ This function turns the particle colors into pixel values for a surface """
+        pixelFormat = (surface.get_bitsize(), surface.get_masks())
+        if pixelFormat != self.pixelFormat:
+            self.pixelFormat = pixelFormat
+            self.mappedColors = numpy.array([surface.map_rgb(color) for color in self.spriteColors],
+                                            numpy.uint32)
+        return self.mappedColors
+
+    def draw(self, screen):
+        """ This function draws every living particle. Each kind of particle is drawn
+        by writing the colors of every particle of that kind into the screen's pixels
+        one pixel of its shape at a time, so the work is done by NumPy whatever the
+        number of particles. Particles that are partly off the screen are not drawn. """
+        if not self.enabled or not self.life.any():
+            return
+
+        # Only screens with 1, 2 or 4 bytes a pixel can be written to directly
+        bytesPerPixel = screen.get_bytesize()
+        if bytesPerPixel == 3:
+            return
+        mappedColors = self.mapColors(screen)
+        # Only 32 bit screens are blended for see-through particles; others draw them solid
+        blending = bytesPerPixel == 4
+
+        # Views the screen's pixels as one long row so each pixel has a single index
+        width, height = screen.get_size()
+        pixels = pygame.surfarray.pixels2d(screen)
+        rowLength = screen.get_pitch() // bytesPerPixel
+        flatPixels = numpy.lib.stride_tricks.as_strided(
+            pixels, shape=(rowLength * (height - 1) + width,), strides=(bytesPerPixel,))
+
+        numpy.copyto(self.drawX, self.x, casting='unsafe')
+        numpy.copyto(self.drawY, self.y, casting='unsafe')
+
+        for kindNo, (shapeWidth, shapeHeight, offsetsX, offsetsY, alpha) in enumerate(self.shapes):
+            # Picks out the living particles of this kind that fit on the screen
+            numpy.equal(self.kind, kindNo, out=self.drawn)
+            numpy.logical_and(self.drawn, self.life, out=self.drawn)
+            numpy.greater_equal(self.drawX, 0, out=self.inside)
+            numpy.logical_and(self.drawn, self.inside, out=self.drawn)
+            numpy.less_equal(self.drawX, width - shapeWidth, out=self.inside)
+            numpy.logical_and(self.drawn, self.inside, out=self.drawn)
+            numpy.greater_equal(self.drawY, 0, out=self.inside)
+            numpy.logical_and(self.drawn, self.inside, out=self.drawn)
+            numpy.less_equal(self.drawY, height - shapeHeight, out=self.inside)
+            numpy.logical_and(self.drawn, self.inside, out=self.drawn)
+            count = numpy.count_nonzero(self.drawn)
+            if count == 0:
+                continue
+
+            # Works out the index of each particle's top left pixel and its color
+            drawnX = numpy.compress(self.drawn, self.drawX, out=self.drawnX[:count])
+            drawnY = numpy.compress(self.drawn, self.drawY, out=self.drawnY[:count])
+            drawnSprite = numpy.compress(self.drawn, self.sprite, out=self.drawnSprite[:count])
+            corners = numpy.multiply(drawnY, rowLength, out=self.corners[:count])
+            corners += drawnX
+            colors = numpy.take(mappedColors, drawnSprite, out=self.colors[:count])
+            pixelIndexes = self.pixelIndexes[:count]
+
+            if alpha == 255 or not blending:
+                # Writes the color into every pixel of the shape
+                for offset in (offsetsY * rowLength + offsetsX).tolist():
+                    numpy.add(corners, offset, out=pixelIndexes)
+                    flatPixels.put(pixelIndexes, colors)
+                continue
+
+            # Weights the color ahead of time, two bytes of the pixel at a time
+            colorLow = numpy.bitwise_and(colors, 0x00FF00FF, out=self.blendLow[:count])
+            colorLow *= alpha
+            colorHigh = numpy.right_shift(colors, 8, out=self.blendHigh[:count])
+            colorHigh &= 0x00FF00FF
+            colorHigh *= alpha
+            oldPixels = self.pixels[:count]
+            low = self.colors[:count]
+            for offset in (offsetsY * rowLength + offsetsX).tolist():
+                numpy.add(corners, offset, out=pixelIndexes)
+                flatPixels.take(pixelIndexes, out=oldPixels)
+                # Blends the low and high bytes of each pixel separately so they cannot overflow
+                numpy.bitwise_and(oldPixels, 0x00FF00FF, out=low)
+                low *= 256 - alpha
+                low += colorLow
+                low >>= 8
+                low &= 0x00FF00FF
+                oldPixels >>= 8
+                oldPixels &= 0x00FF00FF
+                oldPixels *= 256 - alpha
+                oldPixels += colorHigh
+                oldPixels &= 0xFF00FF00
+                oldPixels |= low
+                flatPixels.put(pixelIndexes, oldPixels)
+
+    def clear(self):
+        """ This function removes every particle """
+        if self.enabled:
+            self.life[:] = 0
+
+# The screen sized image loaded from each background file, shared by every round
+layerImages = {}
+
+def layerImage(fileName, transparent=False):
+    """ This function returns a background image the size of the screen that wraps
+    around without a seam, loading it the first time it is asked for. The image is
+    scaled a little wider than the screen, and the extra part past the right edge is
+    faded into the start of the image, so the right edge runs on into the left. """
+    if fileName not in layerImages:
+        # Load and scale the background image
+        image = pygame.image.load(fileName)
+        image = image.convert_alpha() if transparent else image.convert()
+        wideImage = pygame.transform.scale(image, (SCREEN_WIDTH + LAYER_BLEND_WIDTH, SCREEN_HEIGHT))
+
+        # Makes a see-through ramp that is solid on the left and clear on the right
+        ramp = pygame.Surface((LAYER_BLEND_WIDTH, 1), pygame.SRCALPHA)
+        for x in range(LAYER_BLEND_WIDTH):
+            ramp.set_at((x, 0), (255, 255, 255, 255 - 255 * x // LAYER_BLEND_WIDTH))
+        ramp = pygame.transform.scale(ramp, (LAYER_BLEND_WIDTH, SCREEN_HEIGHT))
+
+        # Fades the part past the right edge over the start of the image
+        extra = pygame.Surface((LAYER_BLEND_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+        extra.blit(wideImage, (0, 0), (SCREEN_WIDTH, 0, LAYER_BLEND_WIDTH, SCREEN_HEIGHT))
+        extra.blit(ramp, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
+        layer = wideImage.subsurface((0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)).copy()
+        layer.blit(extra, (0, 0))
+        layerImages[fileName] = layer
+    return layerImages[fileName]
+
+class ParallaxLayer(object):
+    """ This class sets up one scrolling layer of a background. Layers further away
+    have smaller scroll factors, so they move more slowly than the platforms. """
+
+    def __init__(self, fileName, scrollFactor, transparent=False):
+        self.image = layerImage(fileName, transparent)
+        # Makes the half size copy now so drawing at half size never has to scale the image
+        self.halfImage = halfSize(self.image)
+        self.scrollFactor = scrollFactor
+
+    def offset(self, shift):
+        """ This function works out how far along its image the layer is for a background shift """
+        return int(-shift * self.scrollFactor) % SCREEN_WIDTH
+
+    def draw(self, screen, offset):
+        """ This function draws the layer, wrapping around to the start of the image """
+        self.drawWrapped(screen, self.image, offset)
+
+    def drawHalfSize(self, screen, offset):
+        """ This function draws the layer onto a half size surface """
+        self.drawWrapped(screen, self.halfImage, offset // 2)
+
+    def drawWrapped(self, screen, image, offset):
+        """ This function draws an image starting offset pixels into it, with the part
+        that runs past its right edge taken from its start. This takes at most two blits. """
+        width = image.get_width()
+        screen.blit(image, (0, 0), (offset, 0, width - offset, image.get_height()))
+        if offset > 0:
+            screen.blit(image, (width - offset, 0), (0, 0, offset, image.get_height()))
 
 class Backgroundsetup(object):
     """ This is a parent class for setting up all of the different
@@ -184,6 +1265,22 @@ class Backgroundsetup(object):
         # Sets the background shift to 0
         self.background_shift = 0
 
+        # The background's layers, furthest away first
+        self.layers = []
+        # Where each layer was last drawn, and a copy of the layers drawn together that
+        # is used while none of them move
+        self.lastOffsets = None
+        self.composite = None
+        self.compositeReady = False
+
+    def addLayer(self, fileName, scrollFactor, transparent=False):
+        """ This function adds a layer in front of the background's other layers """
+        self.layers.append(ParallaxLayer(fileName, scrollFactor, transparent))
+
+        # Only a background with several layers saves anything by keeping them drawn together
+        if len(self.layers) == 2:
+            self.composite = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+
     def update(self):
         """ This function updates everything on the current background."""
         self.platform_list.update()
@@ -191,11 +1288,34 @@ class Backgroundsetup(object):
     def draw(self, screen):
         """ This function draws everything that is on the current background """
 
-        screen.blit(self.background, [0, 0])
+        offsets = [layer.offset(self.background_shift) for layer in self.layers]
+
+        if offsets == self.lastOffsets and self.compositeReady:
+            # Draws all of the layers at once since none of them have moved
+            screen.blit(self.composite, [0, 0])
+        else:
+            for layer, offset in zip(self.layers, offsets):
+                layer.draw(screen, offset)
+
+            # Keeps a copy of the layers once they have stopped moving
+            self.compositeReady = self.composite is not None and offsets == self.lastOffsets
+            if self.compositeReady:
+                self.composite.blit(screen, [0, 0], (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
+        self.lastOffsets = offsets
 
         # This draws the platforms that are in the platform list
         self.platform_list.draw(screen)
 
+    def drawHalfSize(self, screen):
+        """ This function draws everything that is on the current background onto a half
+        size surface """
+
+        for layer in self.layers:
+            layer.drawHalfSize(screen, layer.offset(self.background_shift))
+
+        # This draws the platforms that are in the platform list
+        drawHalfSize(screen, self.platform_list)
+
     def shift_background(self, shiftX):
         """ This function moves the objects on the screen when the background shifts"""
         self.background_shift += shiftX
@@ -210,9 +1330,8 @@ class Background1(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player, bull)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet1.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet1.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -268,9 +1387,8 @@ class Background2(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player, bull)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet2.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet2.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -326,9 +1444,8 @@ class Background3(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player, bull)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet3.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet3.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -385,9 +1502,8 @@ class Background4(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player, bull)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet4.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet4.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -443,9 +1559,8 @@ class Background5(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player, bull)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet5.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet5.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -501,9 +1616,8 @@ class Background6(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player, bull)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet6.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet6.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -559,9 +1673,8 @@ class Background7(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player, bull)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet7.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet7.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -617,9 +1730,8 @@ class Background7Copy(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
 
         Backgroundsetup.__init__(self, player, bull)
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundstreet7.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundstreet7.jpg', STREET_SCROLL_FACTOR)
         # Sets the background limit the length of the current background
         self.background_limit = -2000
 
@@ -630,16 +1742,489 @@ class BackgroundFinal(Backgroundsetup):
         # Passes the specific background information to the parent background set up class
         Backgroundsetup.__init__(self, player)
 
-        # Load and scale the first background image
-        self.background = pygame.image.load('backgroundfinal.jpg').convert()
-        self.background = pygame.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        # Sets up the street image, which scrolls behind the platforms
+        self.addLayer('backgroundfinal.jpg', STREET_SCROLL_FACTOR)
+
+
+def memoryReport(backgroundList, groups):
+    """ This function measures the memory held by the backgrounds, sprites and
+    their surfaces. The groups are given as a dictionary of names to sprite groups. """
+    global tracingSince
+
+    # Collects every surface once along with the names of whatever holds it
+    surfaces = {}
+
+    def addSurface(surface, owner):
+        """ This function adds a surface and one of the names of whatever holds it """
+        if id(surface) not in surfaces:
+            surfaces[id(surface)] = (surface, [])
+        surfaces[id(surface)][1].append(owner)
+
+    # Adds the platform groups of every background to the groups being counted
+    groups = dict(groups)
+    for number, background in enumerate(backgroundList):
+        name = '%s[%s]' % (type(background).__name__, number)
+        for layerNo, layer in enumerate(background.layers):
+            addSurface(layer.image, '%s.layers[%s].image' % (name, layerNo))
+            addSurface(layer.halfImage, '%s.layers[%s].halfImage' % (name, layerNo))
+        if background.composite is not None:
+            addSurface(background.composite, name + '.composite')
+        groups[name + '.platform_list'] = background.platform_list
+
+    # Counts the sprites in every group by their type
+    spriteCounts = {}
+    groupReport = {}
+    for name, group in groups.items():
+        groupCounts = {}
+        for sprite in group:
+            spriteType = type(sprite).__name__
+            groupCounts[spriteType] = groupCounts.get(spriteType, 0) + 1
+            addSurface(sprite.image, '%s.%s' % (name, spriteType))
+        for spriteType, count in groupCounts.items():
+            spriteCounts[spriteType] = spriteCounts.get(spriteType, 0) + count
+        groupReport[name] = {'type': type(group).__name__, 'sprites': groupCounts}
+
+    # Lists every surface and groups the surfaces that hold exactly the same pixels
+    surfaceList = []
+    copies = {}
+    pixelBytes = 0
+    for surface, owners in surfaces.values():
+        size = surface.get_pitch() * surface.get_height()
+        pixelBytes += size
+        surfaceList.append({'owners': owners, 'size': list(surface.get_size()),
+                            'bitDepth': surface.get_bitsize(), 'pixelBytes': size})
+        digest = hashlib.sha1(surface.get_buffer().raw).hexdigest()
+        key = (surface.get_size(), surface.get_bitsize(), digest)
+        if key not in copies:
+            copies[key] = {'hash': digest, 'size': list(surface.get_size()), 'pixelBytes': size,
+                           'copies': 0, 'owners': []}
+        copies[key]['copies'] += 1
+        copies[key]['owners'].extend(owners)
+
+    duplicates = [group for group in copies.values() if group['copies'] > 1]
+    for group in duplicates:
+        group['wastedBytes'] = group['pixelBytes'] * (group['copies'] - 1)
+    duplicates.sort(key=lambda group: group['wastedBytes'], reverse=True)
+    surfaceList.sort(key=lambda entry: entry['pixelBytes'], reverse=True)
+
+    # Lists the lines of code that allocated the most memory. If allocations are not being
+    # traced yet, tracing starts now and the next report lists what was allocated since.
+    topAllocations = []
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        tracingSince = time.time()
+    else:
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+            frame = stat.traceback[0]
+            topAllocations.append({'file': frame.filename, 'line': frame.lineno,
+                                   'bytes': stat.size, 'blocks': stat.count})
+
+    # Reads the most memory the whole process has used (Linux reports kilobytes)
+    peakBytes = None
+    if resource is not None:
+        peakBytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peakBytes *= 1024
+
+    return {
+        'time': time.time(),
+        'surfaces': {'count': len(surfaces), 'pixelBytes': pixelBytes},
+        'surfaceList': surfaceList,
+        'duplicateSurfaces': duplicates,
+        'sprites': spriteCounts,
+        'groups': groupReport,
+        'topAllocations': topAllocations,
+        'allocationsTracedSince': tracingSince,
+        'peakProcessBytes': peakBytes,
+        'budgetBytes': MEMORY_BUDGET,
+        'overBudget': peakBytes is not None and peakBytes > MEMORY_BUDGET
+    }
+
+def writeMemoryReport(backgroundList, groups, fileName=MEMORY_REPORT_FILE):
+    """ This function writes a memory report out as JSON """
+    with open(fileName, 'w') as reportFile:
+        json.dump(memoryReport(backgroundList, groups), reportFile, indent=2)
+
+class FramePacer(object):
+    """ This class waits for the next frame with one of several strategies and keeps
+    statistics on how evenly the frames are shown. During a round a frame is due when
+    the next simulation tick is:
+    tick            sleeps with time.sleep until the frame is due
+    tick_busy_loop  spins until the frame is due
+    hybrid          sleeps until shortly before the frame is due and then spins
+    vsync           lets the display flip wait for the monitor's refresh
+    When no tick time is given, tick and tick_busy_loop wait with
+    pygame.time.Clock.tick and pygame.time.Clock.tick_busy_loop instead. """
+
+    def __init__(self, strategy, fps=FPS):
+        self.strategy = strategy
+        self.fps = fps
+        self.frameTime = 1.0 / fps
+        self.clock = pygame.time.Clock()
+        # The game screen once it is open and the size it was asked to open at, which
+        # can differ from the screen's own size if the driver picked another mode
+        self.screen = None
+        self.screenSize = None
+        # How many frames in a row the vsync flip came back too early
+        self.fastFrames = 0
+        self.reset()
+
+    def reset(self):
+        """ This function clears the statistics, for example at the start of a round """
+        self.deadline = None
+        self.lastFlip = None
+        self.frames = 0
+        self.missed = 0
+        self.mean = 0.0
+        self.squares = 0.0
+        self.worst = 0.0
+        self.histogram = [0] * PACING_HISTOGRAM_BUCKETS
+
+    def openDisplay(self, size):
+        """ This function sets up the game screen, asking for vsync if the strategy uses it.
+        Every screen in the game is opened through here, so the display is only set up
+        once and keeps the same mode from round to round. """
+        if self.screen is not None and self.screenSize == tuple(size):
+            return self.screen
+        self.screenSize = tuple(size)
+
+        if self.strategy == 'vsync':
+            try:
+                self.screen = pygame.display.set_mode(size, pygame.FULLSCREEN | pygame.SCALED, vsync=1)
+                return self.screen
+            except pygame.error:
+                # Falls back to the hybrid strategy if the display cannot do vsync
+                self.strategy = 'hybrid'
+        self.screen = pygame.display.set_mode(size, pygame.FULLSCREEN)
+        return self.screen
+
+    def present(self, show=True, tickDue=None):
+        """ This function waits until the next frame is due, updates the screen unless
+        show is False and returns how many milliseconds passed since the last frame.
+        If the time the next simulation tick is due is given, every strategy except
+        vsync waits for that time instead, so each frame has a tick to show. """
+        if tickDue is not None and self.strategy != 'vsync':
+            self.waitUntil(tickDue)
+        elif self.strategy == 'tick':
+            self.clock.tick(self.fps)
+        elif self.strategy == 'tick_busy_loop':
+            self.clock.tick_busy_loop(self.fps)
+        elif self.strategy == 'hybrid':
+            self.waitForDeadline()
+
+        if show:
+            pygame.display.flip()
 
+        # Measures the time between this flip and the last one
+        now = time.perf_counter()
+        frameMs = 0.0
+        if self.lastFlip is not None:
+            frameMs = (now - self.lastFlip) * 1000
+            self.recordFrame(frameMs)
+            if self.strategy == 'vsync' and show:
+                self.checkVsync(frameMs)
+        self.lastFlip = now
+        return frameMs
+
+    def checkVsync(self, frameMs):
+        """ This function switches to the hybrid strategy if the driver accepted vsync
+        but its flips keep coming back well before the refresh is due """
+        if frameMs < self.frameTime * 1000 * VSYNC_FAST_SHARE:
+            self.fastFrames += 1
+        else:
+            self.fastFrames = 0
+
+        if self.fastFrames >= VSYNC_FAST_FRAMES:
+            self.strategy = 'hybrid'
+            self.deadline = None
+
+    def waitForDeadline(self):
+        """ This function sleeps most of the way to the next frame and spins the rest """
+        now = time.perf_counter()
+        if self.deadline is None or now - self.deadline > self.frameTime:
+            # Starts over instead of rushing frames out after falling a whole frame behind
+            self.deadline = now + self.frameTime
+
+        self.waitUntil(self.deadline)
+        self.deadline += self.frameTime
+
+    def waitUntil(self, deadline):
+        """ This function waits until a time from time.perf_counter, by sleeping, spinning
+        or sleeping most of the way and spinning the rest, depending on the strategy """
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            if self.strategy == 'tick':
+                time.sleep(remaining)
+            elif self.strategy == 'hybrid' and remaining > PACING_SPIN_TIME:
+                time.sleep(remaining - PACING_SPIN_TIME)
+
+    def recordFrame(self, frameMs):
+        """ This function adds a frame time to the statistics """
+        self.frames += 1
+
+        # Keeps a running mean and variance (Welford's method)
+        difference = frameMs - self.mean
+        self.mean += difference / self.frames
+        self.squares += difference * (frameMs - self.mean)
+        self.worst = max(self.worst, frameMs)
+
+        # A frame that takes more than one and a half frames means a whole refresh was missed
+        if frameMs > self.frameTime * 1500:
+            self.missed += 1
+
+        self.histogram[min(int(frameMs), PACING_HISTOGRAM_BUCKETS - 1)] += 1
+
+    def stats(self):
+        """ This function returns the frame pacing statistics so far """
+        variance = self.squares / self.frames if self.frames else 0.0
+        return {
+            'strategy': self.strategy,
+            'frames': self.frames,
+            'meanMs': self.mean,
+            'varianceMs': variance,
+            'stdDevMs': math.sqrt(variance),
+            'worstMs': self.worst,
+            'missedDeadlines': self.missed,
+            'histogram': list(self.histogram)
+        }
+
+class QualityGovernor(object):
+    """ This class works out how many simulation ticks are due each frame, so the game
+    runs at the same speed however long frames take. It watches how long each frame
+    takes to work out and draw, and lowers the quality one level at a time when frames
+    run over budget, raising it again once there is time to spare:
+    full           everything is drawn
+    slowHud        the score and lives text is only made again every few frames
+    noEffects      the particles and the ghost are not drawn
+    lowResolution  the game is drawn at half size and scaled up to the screen
+    skipFrames     only every other frame is drawn """
+
+    def __init__(self, fps=FPS):
+        self.tickTime = 1.0 / fps
+        self.level = 0
+        # The work times of the latest frames and how many frames since the last change
+        self.workTimes = collections.deque(maxlen=GOVERNOR_WINDOW)
+        self.framesSinceChange = 0
+        self.reset()
+
+    def reset(self):
+        """ This function starts the tick count over, for example at the start of a round """
+        self.lastTime = None
+        self.frameStart = None
+        self.pending = 0.0
+        self.frameNo = 0
+
+    def ticksDue(self):
+        """ This function is called at the start of each frame and returns how many
+        simulation ticks have to run to catch up with the clock """
+        now = time.perf_counter()
+        self.frameStart = now
+        self.frameNo += 1
+        if self.lastTime is None:
+            self.lastTime = now
+            return 1
+
+        self.pending += now - self.lastTime
+        self.lastTime = now
+        ticks = int((self.pending + TICK_SLACK) / self.tickTime)
+        self.pending -= ticks * self.tickTime
+
+        # Lets go of time the game cannot catch up on, for example after a long pause
+        if ticks > MAX_TICKS_PER_FRAME:
+            ticks = MAX_TICKS_PER_FRAME
+            self.pending = 0.0
+        return ticks
+
+    def nextTickDue(self):
+        """ This function returns the time.perf_counter time the next simulation tick is
+        due, or None before the first frame """
+        if self.lastTime is None:
+            return None
+        return self.lastTime + self.tickTime - self.pending
+
+    def shouldRender(self):
+        """ This function returns whether this frame is drawn """
+        return self.level < 4 or self.frameNo % 2 == 0
+
+    def hudDue(self):
+        """ This function returns whether the score and lives text is made again this frame """
+        return self.level < 1 or self.frameNo % HUD_REFRESH_FRAMES == 0
+
+    def effectsOn(self):
+        """ This function returns whether the particles and the ghost are drawn """
+        return self.level < 2
+
+    def lowResolution(self):
+        """ This function returns whether the game is drawn at half size """
+        return self.level >= 3
+
+    def endFrame(self):
+        """ This function is called once a frame is drawn, before waiting for the next
+        one, and changes the quality if the latest frames call for it """
+        self.workTimes.append(time.perf_counter() - self.frameStart)
+        self.framesSinceChange += 1
+        if self.framesSinceChange < GOVERNOR_WINDOW:
+            return
+
+        average = sum(self.workTimes) / len(self.workTimes)
+        # Only half the frames are drawn when skipping frames, so each drawn frame costs about double
+        if self.level == 4:
+            average *= 2
+
+        if average > self.tickTime * GOVERNOR_STEP_DOWN and self.level < len(QUALITY_LEVELS) - 1:
+            self.changeLevel(self.level + 1, average)
+        elif average < self.tickTime * GOVERNOR_STEP_UP and self.level > 0:
+            self.changeLevel(self.level - 1, average)
+
+    def changeLevel(self, level, average):
+        """ This function changes the quality level and logs the change """
+        self.level = level
+        self.framesSinceChange = 0
+        self.workTimes.clear()
+        print('Quality changed to %s, frames were taking %.1f ms to work out and draw' % (
+            QUALITY_LEVELS[level], average * 1000), file=sys.stderr)
+        telemetry.send('qualityChange', level=level, quality=QUALITY_LEVELS[level],
+                       averageMs=average * 1000)
+
+# Half size copies of images, made the first time the game is drawn at half size
+halfSizeImages = weakref.WeakKeyDictionary()
+
+def halfSize(image):
+    """ This function returns a half size copy of an image """
+    if image not in halfSizeImages:
+        halfSizeImages[image] = pygame.transform.scale(image, (image.get_width() // 2,
+                                                               image.get_height() // 2))
+    return halfSizeImages[image]
+
+def drawHalfSize(surface, sprites):
+    """ This function draws a group of sprites onto a half size surface """
+    for sprite in sprites:
+        surface.blit(halfSize(sprite.image), (sprite.rect.x // 2, sprite.rect.y // 2))
+
+class TelemetryStream(object):
+    """ This class takes events from the game loop without ever making it wait and
+    writes them from a background thread into rotating, gzip compressed files with
+    one JSON event per line. Nothing is written if no directory is given. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.queue = None
+        # Counts the events that had to be thrown away because the writer fell behind,
+        # and how many of them have been reported in a log already
+        self.dropped = 0
+        self.reportedDropped = 0
+        if directory is None:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue(TELEMETRY_QUEUE_SIZE)
+        # Names this session so its events can be told apart from other cabinets'
+        self.session = '%d-%d' % (time.time(), os.getpid())
+
+        # The file being written, its number and how many bytes have gone into it
+        self.logFile = None
+        self.fileNo = 0
+        self.fileBytes = 0
+
+        self.thread = threading.Thread(target=self.writeEvents, name='telemetry', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def send(self, kind, **fields):
+        """ This function queues an event. It never waits; if the queue is full the
+        event is dropped. """
+        if self.queue is None:
+            return
+        fields['event'] = kind
+        fields['session'] = self.session
+        fields['time'] = time.time()
+        try:
+            self.queue.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    def newlyDropped(self):
+        """ This function returns how many events were dropped since it was last called """
+        dropped = self.dropped - self.reportedDropped
+        self.reportedDropped = self.dropped
+        return dropped
+
+    def writeEvents(self):
+        """ This function runs on the background thread and writes the queued events """
+        while True:
+            # Waits for an event and then takes whatever else is already waiting
+            batch = [self.queue.get()]
+            while len(batch) < TELEMETRY_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None is put on the queue to stop the thread
+            events = [event for event in batch if event is not None]
+            if events:
+                lines = ''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events)
+                self.writeLines(lines.encode('utf-8'))
+
+            if len(events) < len(batch):
+                if self.logFile is not None:
+                    self.logFile.close()
+                return
 
-def waitForPlayerToPressKey():
+    def writeLines(self, data):
+        """ This function writes lines to the current log file, starting a new file when
+        the current one is full """
+        if self.logFile is None or self.fileBytes >= TELEMETRY_FILE_BYTES:
+            self.rotate()
+        self.logFile.write(data)
+        # Flushes each batch so a crash only loses the events still in the queue
+        self.logFile.flush()
+        self.fileBytes += len(data)
+
+    def rotate(self):
+        """ This function closes the current log file, opens the next one and deletes
+        the oldest files if the directory is over its cap """
+        if self.logFile is not None:
+            self.logFile.close()
+
+        self.fileNo += 1
+        fileName = 'telemetry-%s-%04d.ndjson.gz' % (self.session, self.fileNo)
+        self.logFile = gzip.open(os.path.join(self.directory, fileName), 'wb')
+        self.fileBytes = 0
+
+        # Deletes the oldest logs until the directory fits under the cap
+        logs = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.ndjson.gz') and name != fileName:
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                logs.append((stat.st_mtime, stat.st_size, path))
+        logs.sort()
+        total = sum(size for modified, size, path in logs)
+        while logs and total > TELEMETRY_DIRECTORY_BYTES:
+            modified, size, path = logs.pop(0)
+            os.remove(path)
+            total -= size
+
+    def close(self):
+        """ This function writes out the events still waiting and stops the thread """
+        if self.queue is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(2)
+
+def waitForPlayerToPressKey(drawFrame=None):
     """ This function waits for a player to press any key before continuing
-    with the game """
+    with the game. If a drawFrame function is given, it is called every frame
+    so the screen can move while the game waits. """
 
+    clock = pygame.time.Clock()
     while True:
+        if drawFrame is not None:
+            drawFrame()
+            clock.tick(FPS)
+
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
@@ -650,6 +2235,14 @@ def waitForPlayerToPressKey():
                     sys.exit()
                 return
 
+def drawConfetti(screen, winningScreen):
+    """ This function drops more confetti and draws the next frame of the winning screen """
+    particles.emit('confetti', 15, 0, -10, SCREEN_WIDTH)
+    particles.update()
+    screen.blit(winningScreen, [0, 0])
+    particles.draw(screen)
+    pygame.display.flip()
+
 def beginningInstructions():
     """ This function sets up the beginning game instructions
     before the main game loop """
@@ -659,7 +2252,7 @@ def beginningInstructions():
     # Hides the mouse
     pygame.mouse.set_visible(False)
     # Creates a surface to display the instructions
-    windowSurface = pygame.display.set_mode(size, pygame.FULLSCREEN)
+    windowSurface = framePacer.openDisplay(size)
 
     # Loads and scales the background image of the instruction screen
     startScreen = pygame.image.load('bullring.jpg').convert()
@@ -689,8 +2282,11 @@ def beginningInstructions():
     windowSurface.blit(gameInstructions6, (45, 450))
     windowSurface.blit(gameInstructions7, (350, 550))
 
-    # Updates the screen and waits for a player to press a key to continue
+    # Updates the screen and loads the sounds while the player reads the instructions
     pygame.display.update()
+    audio.preload()
+
+    # Waits for a player to press a key to continue
     waitForPlayerToPressKey()
 
 def main():
@@ -700,18 +2296,28 @@ def main():
     topScore = 0
     loseGame = False
 
+    # Sets whether the frame pacing statistics are shown
+    showPacingStats = False
+
+    # Sets up the governor that keeps the game speed steady and lowers the quality when needed
+    governor = QualityGovernor()
+
+    # Counts the runs so their telemetry events can be grouped
+    runNo = 0
+
     while True:
 
         # Starts the music
-        pygame.mixer.music.play(-1, 0.0)
+        audio.startMusic()
 
         # Sets the values of the score and max lives
         score = 0
         maxLives = 3
+        runNo += 1
 
         # Sets the screen dimensions
         size = [SCREEN_WIDTH, SCREEN_HEIGHT]
-        screen = pygame.display.set_mode(size, pygame.FULLSCREEN)
+        screen = framePacer.openDisplay(size)
 
         # Sets the game captions
         pygame.display.set_caption("Bull Run")
@@ -719,6 +2325,24 @@ def main():
         # Sets the speed of the bull
         bullchangeX = 1
 
+        # Opens the saved best run, if there is one
+        ghostReader = loadGhost()
+
+        # Lays out the same course as the other cabinets in a race, or else the course
+        # the saved best run was on so its ghost jumps over the same platforms
+        if raceClient is not None:
+            courseSeed = raceClient.seed
+        elif ghostReader is not None:
+            courseSeed = ghostReader.seed
+        else:
+            courseSeed = random.getrandbits(32)
+        random.seed(courseSeed)
+
+        # Leaves out a ghost that ran on a different course from the race's
+        if ghostReader is not None and ghostReader.seed != courseSeed:
+            ghostReader.close()
+            ghostReader = None
+
         # Create the player and the bull
         player = Player()
         bull = Bull()
@@ -742,6 +2366,19 @@ def main():
         currentSprites = pygame.sprite.Group()
         player.level = currentBackground
 
+        # Records this run and, if there is a saved best run, adds its ghost behind the player
+        ghostRecorder = GhostRecorder(courseSeed)
+        ghost = None
+        if ghostReader is not None:
+            ghost = Ghost(ghostReader)
+            currentSprites.add(ghost)
+
+        # The toreros showing the other players in a race, by their player number. Their
+        # image is made now so an opponent joining never loads it in the middle of the round.
+        opponents = {}
+        if raceClient is not None:
+            shadowImage(RACE_OPPONENT_ALPHA, RACE_OPPONENT_TINT)
+
         # Sets the x and y direction of the player
         player.rect.x = 100
         player.rect.y = SCREEN_HEIGHT - player.rect.height
@@ -759,14 +2396,24 @@ def main():
         # Sets the game to loop until the player exits the game.
         done = False
 
-        # Manages how fast the screen updates
-        clock = pygame.time.Clock()
+        # Starts the frame pacing statistics, the tick count and the particle effects over for the round
+        framePacer.reset()
+        governor.reset()
+        particles.clear()
+
+        # Sets up the surface the game is drawn on when the governor lowers the resolution,
+        # and the part of the screen it is scaled up onto
+        lowResolutionScreen = pygame.Surface((SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)).convert()
+        gameArea = screen.subsurface((0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
+
+        # The score, fastest score and lives text, which is made when the screen is first drawn
+        textScore = None
 
         # Main program loop
         while not done:
 
-            # Increases the score with each loop
-            score += 1
+            # Works out how many simulation ticks to run to keep up with the clock
+            ticks = governor.ticksDue()
 
             # Quits the game if the user closes out the window
             for event in pygame.event.get():
@@ -785,6 +2432,10 @@ def main():
                     if event.key == pygame.K_ESCAPE:
                         pygame.quit()
                         sys.exit()
+                    if event.key == MEMORY_REPORT_KEY:
+                        writeMemoryReport(backgroundList, {'currentSprites': currentSprites})
+                    if event.key == PACING_STATS_KEY:
+                        showPacingStats = not showPacingStats
 
                 # Keeps the player from moving when no key is pressed
                 if event.type == pygame.KEYUP:
@@ -797,89 +2448,171 @@ def main():
                     if event.key == ord('d') and player.changeX > 0:
                         player.standStill()
 
-            # Moves the bull
-            bull.rect.x += bullchangeX
-            # Moves the bull back to the left side of the screen after it runs off the right
-            if bull.rect.x >= SCREEN_WIDTH:
-                bull.rect.x = -200
-
-            # If the player runs into the bull
-            if player.rect.colliderect(bull):
-                # Moves the bull backwards 200 pixels
-                bull.rect.x = -200
-                # Plays the angry bull sound effect
-                bullSoundEffect.play()
-                # Takes away a life
-                maxLives -= 1
-
-            # Exits the main game loop if the player runs out of lives
-            if maxLives == 0:
-                pygame.mixer.music.stop()
-                gameOverSound.play()
-                time.sleep(1)
-                loseGame = True
-                break
-
-            # Updates the sprites
-            currentSprites.update()
-
-            # Updates the platforms for the current background
-            currentBackground.update()
-
-            # Scrolls the background right to keep the player on the screen
-            if player.rect.right >= 500:
-                diff = player.rect.right - 500
-                player.rect.right = 500
-                currentBackground.shift_background(-diff)
-            # Scrolls the background left to keep the player on the screen
-            if player.rect.left <= 100:
-                diff = 100 - player.rect.left
-                player.rect.left = 100
-                currentBackground.shift_background(diff)
-
-            # Pin points the character position based on its x location and the background shift
-            playerPosition = player.rect.x + currentBackground.background_shift
-
-            # Changes to the next background in the background list
-            if playerPosition < currentBackground.background_limit:
-                player.rect.x = 120
-                if currentBackgroundNo < len(backgroundList):
-                    currentBackgroundNo += 1
-                    currentBackground = backgroundList[currentBackgroundNo]
-                    player.level = currentBackground
-
-                # Exits the game if the player has made it through all the backgrounds
-                if currentBackgroundNo == len(backgroundList) - 1:
-                    # Checks to make sure the player does not run into the bull at the same time as it wins
-                    if maxLives > 0:
-                        loseGame = False
-                        break
-                    if maxLives == 0:
-                        loseGame = True
+            for tick in range(ticks):
+
+                # Increases the score with each tick
+                score += 1
+
+                # Moves the bull
+                bull.rect.x += bullchangeX
+                # Moves the bull back to the left side of the screen after it runs off the right
+                if bull.rect.x >= SCREEN_WIDTH:
+                    bull.rect.x = -200
+
+                # If the player runs into the bull, checking the pixels only once the rectangles touch
+                if player.rect.colliderect(bull.rect) and pygame.sprite.collide_mask(player, bull):
+                    # Moves the bull backwards 200 pixels
+                    bull.rect.x = -200
+                    # Plays the angry bull sound effect and shows a burst where the bull hit
+                    audio.play('bull')
+                    particles.emit('impact', 200, player.rect.centerx, player.rect.centery)
+                    # Takes away a life
+                    maxLives -= 1
+                    telemetry.send('lifeLost', run=runNo, background=currentBackgroundNo,
+                                   score=score, lives=maxLives)
+
+                # Exits the main game loop if the player runs out of lives
+                if maxLives == 0:
+                    audio.stopMusic()
+                    audio.play('gameOver')
+                    time.sleep(1)
+                    loseGame = True
+                    done = True
+                    break
+
+                # Updates the sprites
+                currentSprites.update()
+
+                # Kicks up dust under the bull's hooves and moves the particles
+                particles.emit('dust', 3, bull.rect.left + 20, bull.rect.bottom - 35, 60)
+                particles.update()
+
+                # Updates the platforms for the current background
+                currentBackground.update()
+
+                # Scrolls the background right to keep the player on the screen
+                if player.rect.right >= 500:
+                    diff = player.rect.right - 500
+                    player.rect.right = 500
+                    currentBackground.shift_background(-diff)
+                    particles.shift(-diff)
+                # Scrolls the background left to keep the player on the screen
+                if player.rect.left <= 100:
+                    diff = 100 - player.rect.left
+                    player.rect.left = 100
+                    currentBackground.shift_background(diff)
+                    particles.shift(diff)
+
+                # Pin points the character position based on its x location and the background shift
+                playerPosition = player.rect.x + currentBackground.background_shift
+
+                # Records the player's position for the ghost of this run
+                ghostRecorder.record(currentBackgroundNo, playerPosition, player.rect.y)
+
+                # Lets the race client send where the player is to the other cabinets
+                if raceClient is not None:
+                    raceClient.state = (currentBackgroundNo, playerPosition, player.rect.y)
+
+                # Changes to the next background in the background list
+                if playerPosition < currentBackground.background_limit:
+                    player.rect.x = 120
+                    if currentBackgroundNo < len(backgroundList):
+                        currentBackgroundNo += 1
+                        currentBackground = backgroundList[currentBackgroundNo]
+                        player.level = currentBackground
+                        telemetry.send('backgroundChange', run=runNo, background=currentBackgroundNo,
+                                       score=score)
+
+                    # Exits the game if the player has made it through all the backgrounds
+                    if currentBackgroundNo == len(backgroundList) - 1:
+                        # Checks to make sure the player does not run into the bull at the same time as it wins
+                        if maxLives > 0:
+                            loseGame = False
+                        if maxLives == 0:
+                            loseGame = True
+                        done = True
                         break
 
-            # Creates text for the score, fastest score, and max lives displayed on the screen during the game
-            textScore = fontScore.render('Speed Score: %s' % (score), 1, RED, None)
-            textTopScore = fontScore.render('Fastest Successful Run: %s' % (topScore), 1, RED, None)
-            textMaxLives = fontScore.render('Lives: %s' % (maxLives), 1, RED, None)
-
-            # Draws the background, sprites, and text onto the screen
-            currentBackground.draw(screen)
-            currentSprites.draw(screen)
-            screen.blit(textScore, (25, 25))
-            screen.blit(textTopScore, (25, 60))
-            screen.blit(textMaxLives, (25, 95))
-
-            clock.tick(FPS)
+            if done:
+                break
 
-            # Updates the screen with everything that was drawn
-            pygame.display.flip()
+            # Skips drawing this frame if the governor is skipping frames
+            rendered = governor.shouldRender()
+            if rendered:
+
+                # Creates text for the score, fastest score, and max lives displayed on the screen during the game
+                if textScore is None or governor.hudDue():
+                    textScore = fontScore.render('Speed Score: %s' % (score), 1, RED, None)
+                    textTopScore = fontScore.render('Fastest Successful Run: %s' % (topScore), 1, RED, None)
+                    textMaxLives = fontScore.render('Lives: %s' % (maxLives), 1, RED, None)
+
+                # Lines the ghost up with the current background, or hides it to save time
+                if ghost is not None:
+                    if governor.effectsOn():
+                        ghost.place(currentBackgroundNo, currentBackground)
+                    else:
+                        ghost.hide()
+
+                # Keeps a torero for each player in the race and lines them up with the current background
+                if raceClient is not None:
+                    for playerNo, opponent in list(opponents.items()):
+                        if raceClient.opponents.get(playerNo) is not opponent.states:
+                            opponent.kill()
+                            del opponents[playerNo]
+                    for playerNo, states in list(raceClient.opponents.items()):
+                        if playerNo not in opponents:
+                            opponents[playerNo] = Opponent(states)
+                            currentSprites.add(opponents[playerNo])
+                    for opponent in opponents.values():
+                        opponent.place(currentBackgroundNo, currentBackground)
+
+                # Draws the background and sprites onto the screen, at half size and scaled
+                # up if the governor has lowered the resolution
+                if governor.lowResolution():
+                    currentBackground.drawHalfSize(lowResolutionScreen)
+                    drawHalfSize(lowResolutionScreen, currentSprites)
+                    pygame.transform.scale(lowResolutionScreen, size, gameArea)
+                else:
+                    currentBackground.draw(screen)
+                    currentSprites.draw(screen)
+                if governor.effectsOn():
+                    particles.draw(screen)
+
+                # Draws the text onto the screen
+                screen.blit(textScore, (25, 25))
+                screen.blit(textTopScore, (25, 60))
+                screen.blit(textMaxLives, (25, 95))
+
+                # Shows the frame pacing statistics if they were turned on
+                if showPacingStats:
+                    pacing = framePacer.stats()
+                    textPacing = fontScore.render('%s: %.1f ms +/- %.1f, missed %s, quality %s' % (
+                        pacing['strategy'], pacing['meanMs'], pacing['stdDevMs'], pacing['missedDeadlines'],
+                        QUALITY_LEVELS[governor.level]), 1, RED, None)
+                    screen.blit(textPacing, (25, 130))
+
+            # Waits for the next frame and updates the screen with everything that was drawn
+            governor.endFrame()
+            framePacer.present(rendered, governor.nextTickDue())
+
+        # Logs how the run ended along with how smoothly it ran
+        telemetry.send('runEnd', run=runNo, score=score, won=not loseGame, lives=maxLives,
+                       background=currentBackgroundNo, frames=framePacer.stats(),
+                       droppedEvents=telemetry.newlyDropped())
+
+        # Finishes reading the ghost of the previous best run
+        if ghostReader is not None:
+            ghostReader.close()
+
+        # Writes a memory report for the round if the game was started with --memory-report
+        if options.memory_report:
+            writeMemoryReport(backgroundList, {'currentSprites': currentSprites})
 
         # Brings up the game over screen if the player loses the game
         if loseGame == True:
 
             # Sets up and scales the game over screen
-            loserScreenSurface = pygame.display.set_mode(size, pygame.FULLSCREEN)
+            loserScreenSurface = framePacer.openDisplay(size)
             loserScreen = pygame.image.load('bullgameover.jpg').convert()
             loserScreen = pygame.transform.scale(loserScreen, (SCREEN_WIDTH, SCREEN_HEIGHT))
             loserScreenSurface.blit(loserScreen, [0, 0])
@@ -902,7 +2635,7 @@ def main():
 
             # Waits for player to press a key to play again and restarts the music
             waitForPlayerToPressKey()
-            pygame.mixer.music.play(-1, 0.0)
+            audio.startMusic()
 
         # Brings up the winning screen if the player wins the game
         if loseGame == False:
@@ -911,8 +2644,12 @@ def main():
             if topScore > score or topScore == 0:
                 topScore = score
 
+            # Saves this run as the new ghost if it beat the saved one
+            if ghostReader is None or score < ghostReader.score:
+                ghostRecorder.save(score)
+
             # Sets up and scales the winning screen
-            finalScreenSurface = pygame.display.set_mode(size, pygame.FULLSCREEN)
+            finalScreenSurface = framePacer.openDisplay(size)
             finalScreen = pygame.image.load('backgroundfinal.jpg').convert()
             finalScreen = pygame.transform.scale(finalScreen, (SCREEN_WIDTH, SCREEN_HEIGHT))
 
@@ -938,9 +2675,33 @@ def main():
             screen.blit(endOfGame3, (100, 250))
             screen.blit(toreroImage, (300, 550))
 
+            # Keeps a copy of the winning screen to drop the confetti over
+            winningScreen = screen.copy()
+            particles.clear()
+
             # Updates the screen when for player to press a key to play again
             pygame.display.update()
-            waitForPlayerToPressKey()
+            if particles.enabled:
+                waitForPlayerToPressKey(lambda: drawConfetti(screen, winningScreen))
+            else:
+                waitForPlayerToPressKey()
+
+# Set up the telemetry log
+telemetry = TelemetryStream(options.telemetry)
+
+# Set up the particle effects
+particles = ParticleSystem()
+
+# Set up the frame pacer that opens the screen and waits for each frame
+framePacer = FramePacer(options.pacing)
+
+# Set up the animation frames shared by every round
+frameCache = FrameCache()
+
+# Joins a race if the game was started with --race
+raceClient = None
+if options.race:
+    raceClient = joinRace(options.race, options.room)
 
 beginningInstructions()
 main()
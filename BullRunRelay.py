@@ -0,0 +1,132 @@
+"""
+Relay server for Bull Run head-to-head races. Every cabinet that joins the same room
+gets the same course seed, and the state each player sends is passed on to the other
+players in the room. To race on one machine, start the relay on the loopback address
+and point each copy of the game at it:
+
+    python BullRunRelay.py --port 8765
+    python BullRun.py --race 127.0.0.1:8765
+
+Every message is one length byte followed by up to 255 bytes, the first of which is
+the message type.
+"""
+
+import argparse, asyncio, random, struct
+
+# Message types
+JOIN = b'J'
+WELCOME = b'W'
+STATE = b'S'
+LEAVE = b'L'
+
+# The most bytes a message can hold after its length byte, and so the longest room name
+MAX_MESSAGE_BYTES = 255
+MAX_ROOM_BYTES = MAX_MESSAGE_BYTES - len(JOIN)
+
+# A welcome holds the player's number in the room and the room's course seed
+WELCOME_FORMAT = struct.Struct('<BI')
+
+# Players are numbered 1 to 255 within a room
+MAX_PLAYERS = 255
+
+# States are not passed on to a player who has this many bytes waiting to be sent to it
+MAX_WAITING_BYTES = 4096
+
+
+async def readMessage(reader):
+    """ This function reads one message, or returns None once the connection closes """
+    try:
+        length = (await reader.readexactly(1))[0]
+        return await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+def writeMessage(writer, message):
+    """ This function sends one message """
+    if len(message) > MAX_MESSAGE_BYTES:
+        raise ValueError('A message can hold at most %s bytes, not %s' % (MAX_MESSAGE_BYTES, len(message)))
+    writer.write(bytes((len(message),)) + message)
+
+class Room(object):
+    """ This class keeps track of the players racing the same course """
+
+    def __init__(self):
+        self.seed = random.getrandbits(32)
+        self.players = {}
+
+    def freePlayerNo(self):
+        """ This function returns a player number nobody in the room has, or None if it is full """
+        for playerNo in range(1, MAX_PLAYERS + 1):
+            if playerNo not in self.players:
+                return playerNo
+        return None
+
+class Relay(object):
+    """ This class accepts players, puts them in rooms and passes their states on """
+
+    def __init__(self):
+        self.rooms = {}
+
+    async def handlePlayer(self, reader, writer):
+        """ This function looks after one player's connection until it closes """
+        message = await readMessage(reader)
+        if message is None or message[:1] != JOIN:
+            writer.close()
+            return
+
+        # Puts the player in the room they asked for
+        roomName = message[1:].decode('utf-8', 'replace')
+        room = self.rooms.setdefault(roomName, Room())
+        playerNo = room.freePlayerNo()
+        if playerNo is None:
+            writer.close()
+            return
+        room.players[playerNo] = writer
+        writeMessage(writer, WELCOME + WELCOME_FORMAT.pack(playerNo, room.seed))
+
+        try:
+            while True:
+                message = await readMessage(reader)
+                if message is None:
+                    break
+                if message[:1] == STATE:
+                    self.broadcast(room, playerNo, STATE + bytes((playerNo,)) + message[1:], True)
+        finally:
+            # Tells the rest of the room the player has left
+            del room.players[playerNo]
+            self.broadcast(room, playerNo, LEAVE + bytes((playerNo,)), False)
+            if not room.players:
+                del self.rooms[roomName]
+            writer.close()
+
+    def broadcast(self, room, senderNo, message, droppable):
+        """ This function sends a message to everyone in a room except the sender. A
+        droppable message is skipped for players who are not keeping up. """
+        for playerNo, writer in room.players.items():
+            if playerNo == senderNo or writer.is_closing():
+                continue
+            if droppable and writer.transport.get_write_buffer_size() > MAX_WAITING_BYTES:
+                continue
+            writeMessage(writer, message)
+
+async def serve(host, port):
+    """ This function runs the relay until it is stopped """
+    relay = Relay()
+    server = await asyncio.start_server(relay.handlePlayer, host, port)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    """ This function reads the command line and starts the relay """
+    parser = argparse.ArgumentParser(description='Relay server for Bull Run races')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='the port to listen on')
+    arguments = parser.parse_args()
+
+    try:
+        asyncio.run(serve(arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
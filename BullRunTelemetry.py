@@ -0,0 +1,155 @@
+"""
+Reads a directory of Bull Run telemetry logs (written by running the game with
+--telemetry DIRECTORY) and prints a summary of every run in them.
+
+Usage: python BullRunTelemetry.py DIRECTORY [--json]
+"""
+
+import argparse, gzip, json, os, sys, zlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+def emptySummary():
+    """ This function creates a summary with nothing counted in it yet """
+    return {
+        'files': 0,
+        'damagedFiles': 0,
+        'events': 0,
+        'droppedEvents': 0,
+        'badLines': 0,
+        'runs': 0,
+        'wins': 0,
+        'scoreTotal': 0,
+        'bestWinningScore': None,
+        'livesLostByBackground': {},
+        'backgroundsReached': {},
+        'frames': 0,
+        'frameMsTotal': 0.0,
+        'worstFrameMs': 0.0,
+        'missedDeadlines': 0
+    }
+
+def readLog(path):
+    """ This function summarizes one log file. A file that is cut short, for example
+    because it is still being written, is read up to where it ends, and a damaged file
+    is read up to the damage. """
+    summary = emptySummary()
+    summary['files'] = 1
+
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as logFile:
+            for line in logFile:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    summary['badLines'] += 1
+                    continue
+                summary['events'] += 1
+                addEvent(summary, event)
+    except EOFError:
+        pass
+    except (OSError, zlib.error):
+        summary['damagedFiles'] = 1
+
+    return summary
+
+def addEvent(summary, event):
+    """ This function counts one event into a summary """
+    kind = event.get('event')
+    background = str(event.get('background'))
+
+    if kind == 'lifeLost':
+        lost = summary['livesLostByBackground']
+        lost[background] = lost.get(background, 0) + 1
+
+    elif kind == 'backgroundChange':
+        reached = summary['backgroundsReached']
+        reached[background] = reached.get(background, 0) + 1
+
+    elif kind == 'runEnd':
+        summary['runs'] += 1
+        summary['scoreTotal'] += event['score']
+        summary['droppedEvents'] += event.get('droppedEvents', 0)
+        if event['won']:
+            summary['wins'] += 1
+            if summary['bestWinningScore'] is None or event['score'] < summary['bestWinningScore']:
+                summary['bestWinningScore'] = event['score']
+
+        frames = event.get('frames', {})
+        summary['frames'] += frames.get('frames', 0)
+        summary['frameMsTotal'] += frames.get('meanMs', 0.0) * frames.get('frames', 0)
+        summary['worstFrameMs'] = max(summary['worstFrameMs'], frames.get('worstMs', 0.0))
+        summary['missedDeadlines'] += frames.get('missedDeadlines', 0)
+
+def combine(total, summary):
+    """ This function adds one summary onto another """
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            for name, count in value.items():
+                total[key][name] = total[key].get(name, 0) + count
+        elif key == 'bestWinningScore':
+            if value is not None and (total[key] is None or value < total[key]):
+                total[key] = value
+        elif key == 'worstFrameMs':
+            total[key] = max(total[key], value)
+        else:
+            total[key] += value
+
+def summarizeDirectory(directory):
+    """ This function reads every log in a directory, several files at a time """
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.endswith('.ndjson.gz'))
+
+    total = emptySummary()
+    with ProcessPoolExecutor() as pool:
+        for summary in pool.map(readLog, paths, chunksize=8):
+            combine(total, summary)
+
+    # Works out the averages once everything has been added up
+    total['averageScore'] = total['scoreTotal'] / total['runs'] if total['runs'] else None
+    total['winRate'] = total['wins'] / total['runs'] if total['runs'] else None
+    total['averageFrameMs'] = total['frameMsTotal'] / total['frames'] if total['frames'] else None
+    return total
+
+def printSummary(summary):
+    """ This function prints a summary for a person to read """
+    print('Files read: %s (%s damaged, %s events, %s unreadable lines)' % (
+        summary['files'], summary['damagedFiles'], summary['events'], summary['badLines']))
+    print('Events the game had to drop: %s' % summary['droppedEvents'])
+    print('Runs: %s, won: %s' % (summary['runs'], summary['wins']))
+    if summary['runs']:
+        print('Win rate: %.1f%%' % (summary['winRate'] * 100))
+        print('Average speed score: %.1f' % summary['averageScore'])
+    if summary['bestWinningScore'] is not None:
+        print('Fastest successful run: %s' % summary['bestWinningScore'])
+
+    print('Lives lost on each background:')
+    for background, count in sorted(summary['livesLostByBackground'].items()):
+        print('  %s: %s' % (background, count))
+    print('Times each background was reached:')
+    for background, count in sorted(summary['backgroundsReached'].items()):
+        print('  %s: %s' % (background, count))
+
+    if summary['frames']:
+        print('Average frame time: %.2f ms over %s frames' % (summary['averageFrameMs'], summary['frames']))
+        print('Worst frame: %.1f ms, missed deadlines: %s' % (summary['worstFrameMs'],
+                                                             summary['missedDeadlines']))
+
+def main():
+    """ This function reads the command line and prints the summary """
+    parser = argparse.ArgumentParser(description='Summarize Bull Run telemetry logs')
+    parser.add_argument('directory', help='the directory the game wrote its telemetry to')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    arguments = parser.parse_args()
+
+    if not os.path.isdir(arguments.directory):
+        sys.exit('%s is not a directory' % arguments.directory)
+
+    summary = summarizeDirectory(arguments.directory)
+    if arguments.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        printSummary(summary)
+
+if __name__ == '__main__':
+    main()